@@ -2,9 +2,11 @@ import streamlit as st
 import pandas as pd
 import gspread
 import time
+import random
+import hmac
 from fpdf import FPDF
-import base64
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 # --- PAGE CONFIG ---
 st.set_page_config(
@@ -21,6 +23,7 @@ FINANCE_SHEET_NAME = "Finance 2025-2026"
 
 SCHOOL_YEARS = ["2025-2026", "2026-2027", "2027-2028"]
 CURRENT_DATE = datetime.now().strftime('%Y-%m-%d')
+DATA_TTL = 60 # Increased TTL to 60s to prevent API Quota crashes
 
 FEE_STRUCTURE = {
     "Pre-K": {"dp": 9000, "monthly": 1175, "books": 4500},
@@ -37,9 +40,18 @@ FEE_STRUCTURE = {
     "Grade 10": {"dp": 11500, "monthly": 1475, "books": 6430},
 }
 MONTHLY_MONTHS = 10
+TOTAL_FEE_BY_GRADE = {g: float(f["dp"] + f["books"] + f["monthly"] * MONTHLY_MONTHS) for g, f in FEE_STRUCTURE.items()}
 GRADE_LEVELS = list(FEE_STRUCTURE.keys())
 STUDENT_TYPES = ["New Student", "Old / Continuing", "Transferee", "Returnee"]
 PAYMENT_METHODS = ["Cash", "GCash", "Bank Transfer", "Check"]
+ENROLLMENT_STATUSES = ["Pending", "Enrolled", "Withdrawn"]
+# Option -> position maps for selectbox defaults (dict get instead of `in` + list.index)
+GRADE_INDEX = {g: i for i, g in enumerate(GRADE_LEVELS)}
+STATUS_INDEX = {s: i for i, s in enumerate(ENROLLMENT_STATUSES)}
+# Low-cardinality sheet columns stored as pandas categoricals (int codes instead of Python strings)
+CATEGORICAL_COLS = ["Grade Level", "Student Type", "PSA Birth Cert", "Report Card / ECCD", "Good Moral", "SF10 Status", "Current Status", "School_Year", "Method", "Type", "Notes", "Status"]
+# Master list columns sent to the browser; the edit section shows the selected student's full row
+REG_DISPLAY_COLS = ["Student_ID", "LRN", "Last Name", "First Name", "Grade Level", "Student Type", "SF10 Status", "Current Status"]
 
 # --- UI STYLING ---
 st.markdown("""
@@ -65,106 +77,256 @@ def get_connection():
 def get_spreadsheets():
     gc = get_connection()
     try:
-        return gc.open(REGISTRAR_SHEET_NAME), gc.open(FINANCE_SHEET_NAME), None
+        # Independent HTTP calls, so open both spreadsheets concurrently
+        with ThreadPoolExecutor(2) as ex:
+            f_reg = ex.submit(gc.open, REGISTRAR_SHEET_NAME)
+            f_fin = ex.submit(gc.open, FINANCE_SHEET_NAME)
+            return f_reg.result(), f_fin.result(), None
     except Exception as e:
         return None, None, e
 
-@st.cache_data(ttl=60) # Increased TTL to 60s to prevent API Quota crashes
-def fetch_sheet_data(_ws):
+def frame_from_values(data, expected_cols, text_cols=()):
+    if len(data) < 2: return pd.DataFrame(columns=list(expected_cols))
+    pos = {}
+    for i, h in enumerate(data[0]): pos.setdefault(str(h).strip(), i)
+    rows = data[1:]
+    # Build each expected column straight from its sheet position, in final order.
+    # Missing headers and cells trimmed off by batchGet become "".
+    cols = {}
+    for col in expected_cols:
+        i = pos.get(col)
+        cols[col] = [r[i] if i is not None and i < len(r) else "" for r in rows]
+    df = pd.DataFrame(cols, columns=list(expected_cols))
+    # Unformatted reads give hand-typed cells as ints/bools next to app-written strings; keep text columns str
+    if text_cols: df = df.astype({c: str for c in text_cols})
+    return df.astype({c: "category" for c in CATEGORICAL_COLS if c in expected_cols})
+
+def read_tabs(sh, tabs, params=None, numeric_cols=None):
+    # One values:batchGet per spreadsheet. With numeric_cols (unformatted reads), every other column is cast to str.
+    # Only the columns the app uses are requested (A..O for the registry, A..I for payments, ...)
+    ranges = [f"'{name}'!A1:{gspread.utils.rowcol_to_a1(1, len(cols))[:-1]}" for name, cols in tabs]
     try:
-        return _ws.get_all_values()
+        value_ranges = sh.values_batch_get(ranges, params=params).get("valueRanges", [])
     except:
-        return []
+        value_ranges = []
+    frames = []
+    for i, (_, cols) in enumerate(tabs):
+        data = value_ranges[i].get("values", []) if i < len(value_ranges) else []
+        text_cols = [c for c in cols if c not in numeric_cols] if numeric_cols is not None else ()
+        frames.append(frame_from_values(data, cols, text_cols))
+    return frames
+
+# One cache per spreadsheet so a write only invalidates the file it touched (_sh is not hashed)
+@st.cache_data(ttl=DATA_TTL)
+def fetch_registrar(_sh, tabs):
+    return read_tabs(_sh, tabs)
+
+@st.cache_data(ttl=DATA_TTL)
+def fetch_finance(_sh, tabs):
+    # Payments_Log unformatted so Amount arrives as a float, not a "1,175" display string to re-parse.
+    # User_Accounts stays formatted: credentials must read back exactly as typed ("TRUE", "50%", "1,000").
+    unformatted = {"valueRenderOption": "UNFORMATTED_VALUE", "dateTimeRenderOption": "FORMATTED_STRING"}
+    with ThreadPoolExecutor(2) as ex:
+        pay = ex.submit(read_tabs, _sh, tabs[:1], unformatted, ("Amount",))
+        users = ex.submit(read_tabs, _sh, tabs[1:])
+        return pay.result() + users.result()
+
+def with_retry(fn, *args, tries=5, **kwargs):
+    # Sheets answers 429 when the per-user quota is hit; back off with jitter instead of losing the write
+    for i in range(tries):
+        try:
+            return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            if e.response.status_code != 429 or i == tries - 1: raise
+            time.sleep(2 ** i + random.random())
+
+@st.cache_resource
+def get_worksheets(_sh_reg, _sh_fin):
+    # Handles are stable for the process; a failed lookup raises and is not cached
+    tabs = [(_sh_reg, "Student_Registry"), (_sh_reg, "SF10_Requests"), (_sh_fin, "Payments_Log"), (_sh_fin, "User_Accounts")]
+    with ThreadPoolExecutor(len(tabs)) as ex:
+        return tuple(ex.map(lambda t: t[0].worksheet(t[1]), tabs))
 
 def load_data():
     sh_reg, sh_fin, error_msg = get_spreadsheets()
     if error_msg:
         st.error(f"❌ Connection Failed: {error_msg}"); st.stop()
 
-    def safe_read(ws, expected_cols):
-        data = fetch_sheet_data(ws)
-        if not data: return pd.DataFrame(columns=expected_cols)
-        headers = [h.strip() for h in data.pop(0)]
-        df = pd.DataFrame(data, columns=headers)
-        for col in expected_cols:
-            if col not in df.columns: df[col] = ""
-        return df[expected_cols]
-
-    # Load Worksheets
+    # Resolve Worksheets (also fails fast on a missing tab; reads go through read_tabs)
     try:
-        ws_reg = sh_reg.worksheet("Student_Registry")
-        ws_sf10 = sh_reg.worksheet("SF10_Requests")
-        ws_pay = sh_fin.worksheet("Payments_Log")
-        ws_users = sh_fin.worksheet("User_Accounts")
+        ws_reg, ws_sf10, ws_pay, ws_users = get_worksheets(sh_reg, sh_fin)
     except Exception as e:
         st.error(f"❌ Missing Tabs in Google Sheets: {e}")
         st.stop()
 
-    df_reg = safe_read(ws_reg, ["Student_ID", "LRN", "Last Name", "First Name", "Middle Name", "Grade Level", "Student Type", "Previous School", "PSA Birth Cert", "Report Card / ECCD", "Good Moral", "SF10 Status", "Data Privacy Consent", "Current Status", "School_Year"])
-    df_sf10 = safe_read(ws_sf10, ["Timestamp", "Student_Name", "Student_ID", "Status"])
-    df_pay = safe_read(ws_pay, ["Date", "OR_Number", "Student_ID", "Student_Name", "Amount", "Method", "Notes", "Type", "School_Year"])
-    df_users = safe_read(ws_users, ["Username", "Password", "Role"])
-
-    df_pay["Amount"] = pd.to_numeric(df_pay["Amount"], errors="coerce").fillna(0.0)
-    df_reg["Student_ID"] = df_reg["Student_ID"].astype(str)
+    reg_tabs = (
+        ("Student_Registry", ("Student_ID", "LRN", "Last Name", "First Name", "Middle Name", "Grade Level", "Student Type", "Previous School", "PSA Birth Cert", "Report Card / ECCD", "Good Moral", "SF10 Status", "Data Privacy Consent", "Current Status", "School_Year")),
+        ("SF10_Requests", ("Timestamp", "Student_Name", "Student_ID", "Status")),
+    )
+    fin_tabs = (
+        ("Payments_Log", ("Date", "OR_Number", "Student_ID", "Student_Name", "Amount", "Method", "Notes", "Type", "School_Year")),
+        ("User_Accounts", ("Username", "Password", "Role")),
+    )
+    df_reg, df_sf10 = fetch_registrar(sh_reg, reg_tabs)
+    df_pay, df_users = fetch_finance(sh_fin, fin_tabs)
+
+    # Sheets may hand back "1,175" for an amount stored as text; strip separators so those don't coerce to 0
+    amt = df_pay["Amount"].astype(str).str.replace(",", "", regex=False)
+    df_pay["Amount"] = pd.to_numeric(amt, errors="coerce").fillna(0.0)
+    # Newest request first, sorted once per load on a parsed key; Timestamp itself is shown as entered
+    when = pd.to_datetime(df_sf10["Timestamp"], format="mixed", errors="coerce")
+    df_sf10 = df_sf10.loc[when.sort_values(ascending=False, kind="stable").index]
     
-    return df_reg, df_sf10, df_pay, df_users, sh_reg, sh_fin
+    # Hand back the resolved tabs so write paths don't re-fetch worksheet metadata
+    return df_reg, df_sf10, df_pay, df_users, ws_reg, ws_pay
+
+@st.cache_resource
+def write_counter():
+    # Process-wide count of sheet writes made through the app, shared by every session
+    return {"n": 0}
+
+def session_is_stale():
+    # Reload after any session's write, or once DATA_TTL lapses (edits made directly in the sheet)
+    ss = st.session_state
+    return ss.get("seen_writes") != write_counter()["n"] or time.time() - ss.get("loaded_at", 0.0) > DATA_TTL
+
+def get_session_data():
+    # Parsed frames live in session state and are reused across reruns until session_is_stale()
+    ss = st.session_state
+    if session_is_stale():
+        writes = write_counter()["n"] # read before loading, so a write landing mid-load triggers another reload
+        ss.data = load_data()
+        ss.loaded_at = time.time(); ss.seen_writes = writes
+        index_session_data()
+    return ss.data
+
+def index_session_data():
+    # Derived lookups over the session frames; rebuilt on reload and after in-place edits
+    ss = st.session_state
+    ss.row_of = build_row_index(ss.data[0]["Student_ID"])
+    ss.reg_search = build_search_blob(ss.data[0])
+    ss.memo = {}
+
+def set_row_values(df, idx, values):
+    # In-place edit of one session row; a categorical column must learn a new value before it is set
+    for col, val in values.items():
+        if isinstance(df[col].dtype, pd.CategoricalDtype) and val not in df[col].cat.categories:
+            df[col] = df[col].cat.add_categories([val])
+        df.at[idx, col] = val
+
+def session_memo(key, build):
+    # Per-session memo tied to the loaded frames (reset on every reload), so reruns skip rebuilding
+    memo = st.session_state.memo
+    if key not in memo: memo[key] = build()
+    return memo[key]
+
+def mark_dirty(fetcher, patched=False):
+    # A write landed: drop that spreadsheet's cache and bump the write counter so every session reloads.
+    # patched=True means this session already applied the edit to its own frames and can skip its reload.
+    fetcher.clear()
+    counter = write_counter(); counter["n"] += 1
+    if patched: st.session_state.seen_writes = counter["n"]
 
 # ==========================================
 # 📈 LOGIC HELPERS
 # ==========================================
 
 def compute_total_fee(grade):
-    fees = FEE_STRUCTURE.get(grade.strip())
-    if not fees: return 0.0
-    return float(fees["dp"]) + float(fees["books"]) + (float(fees["monthly"]) * MONTHLY_MONTHS)
+    return TOTAL_FEE_BY_GRADE.get(grade.strip(), 0.0)
+
+def payments_index(df_pay):
+    # One groupby pass; balance/allocation lookups become dict gets instead of full-frame masks.
+    # Built once per data load through session_memo, so reruns don't re-hash df_pay.
+    by_note = df_pay.groupby(["Student_ID", "School_Year", "Notes"], observed=True)["Amount"].sum()
+    totals = by_note.groupby(level=[0, 1], observed=True).sum()
+    return by_note.to_dict(), totals.to_dict()
 
-def get_financials(sid, grade, df_pay, sy):
+def paid_by_category(by_note, sid, sy, category):
+    return float(by_note.get((sid, sy, category), 0.0))
+
+def get_financials(sid, grade, totals, sy):
     total_fee = compute_total_fee(grade)
-    paid = float(df_pay[(df_pay["Student_ID"] == sid) & (df_pay["School_Year"] == sy)]["Amount"].sum())
+    paid = float(totals.get((sid, sy), 0.0))
     return round(total_fee, 2), round(paid, 2), round(total_fee - paid, 2)
 
-def distribute_payment(grade, amount, df_pay, sid, sy):
+def allocate_amount(dp_due, books_due, amount):
+    # Pure-float core: DP first, then Books, the rest goes to Monthly Tuition
+    remaining = amount
+    dp_take = min(dp_due, remaining); remaining -= dp_take
+    books_take = min(books_due, remaining); remaining -= books_take
+    return dp_take, books_take, remaining
+
+def distribute_payment(grade, amount, paid_dp, paid_books):
+    # Pure on its arguments; callers pass what was already paid toward DP and Books
     fees = FEE_STRUCTURE.get(grade.strip())
     if not fees: return {"Tuition Payment": float(amount)}
-    remaining = float(amount); alloc = {}
-    
-    # Priority 1: DP
-    paid_dp = float(df_pay[(df_pay["Student_ID"] == sid) & (df_pay["Notes"] == "DP") & (df_pay["School_Year"] == sy)]["Amount"].sum())
     dp_due = max(0.0, float(fees["dp"]) - paid_dp)
-    if dp_due > 0 and remaining > 0:
-        take = min(dp_due, remaining); alloc["DP"] = take; remaining -= take
-        
-    # Priority 2: Books
-    paid_books = float(df_pay[(df_pay["Student_ID"] == sid) & (df_pay["Notes"] == "Books") & (df_pay["School_Year"] == sy)]["Amount"].sum())
     books_due = max(0.0, float(fees["books"]) - paid_books)
-    if books_due > 0 and remaining > 0:
-        take = min(books_due, remaining); alloc["Books"] = take; remaining -= take
-        
-    if remaining > 0: alloc["Monthly Tuition"] = remaining
-    return alloc
+    takes = allocate_amount(dp_due, books_due, float(amount))
+    return {k: v for k, v in zip(["DP", "Books", "Monthly Tuition"], takes) if v > 0}
+
+def next_student_id(ws, sy):
+    # Fresh read of column A: concurrent enrollments see each other's rows, unlike a cached len(df_reg)
+    nums = [int(v.split("-")[-1]) for v in with_retry(ws.col_values, 1) if "-" in v and v.split("-")[-1].isdigit()]
+    return f"{sy[:4]}-{max(nums, default=0) + 1:04d}"
+
+def build_search_options(df):
+    # Vectorized label build; returns (ids, {id: label}) for a format_func selectbox
+    ids = df["Student_ID"].tolist()
+    labels = (df["Last Name"] + ", " + df["First Name"] + " (" + df["Student_ID"] + ")").tolist()
+    return ids, dict(zip(ids, labels))
+
+def grade_counts(grades):
+    # Categorical value_counts also lists grades only seen in other years; drop the zeros
+    counts = grades.value_counts()
+    return counts[counts > 0]
+
+def recent_payments(sy_pay, n=5):
+    # Sheet order isn't date order. Rank on a parsed key (format="mixed": hand-typed dates need not match
+    # the app's); Date itself is shown exactly as entered. Later rows win ties, unparseable dates sort last.
+    when = pd.to_datetime(sy_pay["Date"], format="mixed", errors="coerce")
+    return sy_pay.loc[when.nlargest(n, keep="last").index, ["Date", "Student_Name", "Amount"]]
+
+def dashboard_kpis(df_reg, df_pay):
+    # Expected fees and collections for every School_Year in one groupby each; the dashboard just indexes by sy
+    expected = df_reg["Grade Level"].str.strip().map(TOTAL_FEE_BY_GRADE).fillna(0.0).groupby(df_reg["School_Year"], observed=True).sum()
+    collected = df_pay.groupby("School_Year", observed=True)["Amount"].sum()
+    return expected.to_dict(), collected.to_dict()
+
+def build_search_blob(df):
+    # Lowercased "last|first|id" per row so a search is one literal contains, no per-keystroke case folding.
+    # Built once per data load by get_session_data; kept apart from df_reg so it never shows in tables.
+    return (df["Last Name"] + "|" + df["First Name"] + "|" + df["Student_ID"]).str.lower()
+
+def build_user_table(df_users):
+    # Username -> (password, role); first occurrence wins
+    rows = list(zip(df_users["Username"], df_users["Password"], df_users["Role"]))
+    return {u: (p, r) for u, p, r in reversed(rows)}
+
+def build_row_index(ids):
+    # Student_ID -> index label of its first row in the given frame (first occurrence wins).
+    # df_reg labels are sheet positions; pass sy_reg to stay within one school year.
+    return dict(zip(reversed(ids.tolist()), reversed(ids.index.tolist())))
 
 # ==========================================
 # 📊 MODULE: DASHBOARD
 # ==========================================
 
-def render_dashboard(df_reg, df_pay, sy):
+def render_dashboard(sy_reg, sy_pay, sy, kpis):
     st.title(f"📊 ALSDI Dashboard • {sy}")
-    sy_reg = df_reg[df_reg["School_Year"] == sy]
-    sy_pay = df_pay[df_pay["School_Year"] == sy]
+    expected, collected = float(kpis[0].get(sy, 0.0)), float(kpis[1].get(sy, 0.0))
 
     c1, c2, c3, c4 = st.columns(4)
     c1.metric("Total Students", len(sy_reg))
-    c2.metric("Total Collections", f"₱{sy_pay['Amount'].sum():,.0f}")
+    c2.metric("Total Collections", f"₱{collected:,.0f}")
     
-    expected = sum([compute_total_fee(g) for g in sy_reg["Grade Level"]])
-    receivables = expected - sy_pay['Amount'].sum()
+    receivables = expected - collected
     c3.metric("Receivables", f"₱{receivables:,.0f}")
     
     # Check if column exists to avoid error
     req_count = 0
     if "SF10 Status" in sy_reg.columns:
-        req_count = len(sy_reg[sy_reg["SF10 Status"] == "Requested"])
+        req_count = int(sy_reg["SF10 Status"].value_counts().get("Requested", 0))
     c4.metric("Registrar Requests", req_count)
 
     st.divider()
@@ -172,57 +334,69 @@ def render_dashboard(df_reg, df_pay, sy):
     with col_a:
         st.subheader("Enrollment by Grade")
         if not sy_reg.empty:
-            st.bar_chart(sy_reg["Grade Level"].value_counts())
+            st.bar_chart(session_memo(("grades", sy), lambda: grade_counts(sy_reg["Grade Level"])))
     with col_b:
         st.subheader("Recent Payments")
         if not sy_pay.empty:
-            st.dataframe(sy_pay[["Date", "Student_Name", "Amount"]].tail(5), hide_index=True)
+            st.dataframe(session_memo(("recent", sy), lambda: recent_payments(sy_pay)), hide_index=True)
 
 # ==========================================
 # 🎓 MODULE: REGISTRAR (VIEW / EDIT / ADD)
 # ==========================================
 
-def render_registrar(df_reg, df_sf10, sh_reg, sy):
+@st.fragment # Searching and picking a row rerun only this tab, not the whole page
+def registrar_list(df_reg, sy_reg, ws_reg, row_of, reg_search):
+    # A fragment rerun skips main(), so check here whether the frames it was handed are out of date
+    if session_is_stale(): st.rerun(scope="app")
+    c1, c2 = st.columns([2, 1])
+    search = c1.text_input("🔍 Search Student Name")
+    view_df = sy_reg
+    if search:
+        view_df = view_df[reg_search.loc[view_df.index].str.contains(search.lower(), regex=False, na=False)]
+    
+    st.dataframe(view_df[REG_DISPLAY_COLS], use_container_width=True, hide_index=True, height=400)
+    
+    st.divider()
+    st.markdown("### ✏️ Edit Student Record")
+    # Ensure we filter list correctly
+    valid_ids = view_df["Student_ID"].unique().tolist()
+    selected_sid = st.selectbox("Select ID to Update", [""] + valid_ids)
+    
+    if selected_sid:
+        # Get the exact row index from the ORIGINAL dataframe to match Google Sheets row number
+        idx = row_of[selected_sid]
+        stu = df_reg.iloc[idx]
+        # Every column, including the requirement checklist the master list leaves out
+        st.dataframe(df_reg.iloc[[idx]], use_container_width=True, hide_index=True)
+        
+        with st.form("edit_student"):
+            ca, cb = st.columns(2)
+            u_ln = ca.text_input("Last Name", value=stu["Last Name"])
+            u_fn = cb.text_input("First Name", value=stu["First Name"])
+            u_gr = ca.selectbox("Grade", GRADE_LEVELS, index=GRADE_INDEX.get(stu["Grade Level"], 0))
+            
+            u_st = cb.selectbox("Status", ENROLLMENT_STATUSES, index=STATUS_INDEX.get(stu["Current Status"], 0))
+            
+            if st.form_submit_button("Save Changes"):
+                row = int(idx) + 2 # +2 because 1 for header, 1 for 0-index
+                with_retry(ws_reg.batch_update, [
+                    {"range": f"C{row}:D{row}", "values": [[u_ln, u_fn]]},
+                    {"range": f"F{row}", "values": [[u_gr]]},
+                    {"range": f"N{row}", "values": [[u_st]]},
+                ], value_input_option="RAW")
+                # Patch this session's copy instead of reloading every tab; the sheet cache is dropped
+                # and other sessions reload, so no one keeps or brings back the pre-edit row
+                set_row_values(df_reg, idx, {"Last Name": u_ln, "First Name": u_fn, "Grade Level": u_gr, "Current Status": u_st})
+                mark_dirty(fetch_registrar, patched=True); index_session_data()
+                st.success("Updated!"); time.sleep(1); st.rerun()
+
+
+def render_registrar(df_reg, sy_reg, df_sf10, ws_reg, sy, row_of, reg_search):
     st.subheader(f"🎓 Admissions Portal ({sy})")
     t_list, t_add, t_sf10 = st.tabs(["📂 Master List & Edit", "📝 New Enrollment", "📜 Document Requests"])
 
     with t_list:
-        c1, c2 = st.columns([2, 1])
-        search = c1.text_input("🔍 Search Student Name")
-        view_df = df_reg[df_reg["School_Year"] == sy]
-        if search:
-            view_df = view_df[view_df["Last Name"].str.contains(search, case=False, na=False) | view_df["First Name"].str.contains(search, case=False, na=False)]
-        
-        st.dataframe(view_df, use_container_width=True, hide_index=True)
-        
-        st.divider()
-        st.markdown("### ✏️ Edit Student Record")
-        # Ensure we filter list correctly
-        valid_ids = view_df["Student_ID"].unique().tolist()
-        selected_sid = st.selectbox("Select ID to Update", [""] + valid_ids)
-        
-        if selected_sid:
-            # Get the exact row index from the ORIGINAL dataframe to match Google Sheets row number
-            idx = df_reg[df_reg["Student_ID"] == selected_sid].index[0]
-            stu = df_reg.iloc[idx]
-            
-            with st.form("edit_student"):
-                ca, cb = st.columns(2)
-                u_ln = ca.text_input("Last Name", value=stu["Last Name"])
-                u_fn = cb.text_input("First Name", value=stu["First Name"])
-                u_gr = ca.selectbox("Grade", GRADE_LEVELS, index=GRADE_LEVELS.index(stu["Grade Level"]) if stu["Grade Level"] in GRADE_LEVELS else 0)
-                
-                status_opts = ["Pending", "Enrolled", "Withdrawn"]
-                curr_stat = stu["Current Status"] if stu["Current Status"] in status_opts else "Pending"
-                u_st = cb.selectbox("Status", status_opts, index=status_opts.index(curr_stat))
-                
-                if st.form_submit_button("Save Changes"):
-                    ws = sh_reg.worksheet("Student_Registry")
-                    row = int(idx) + 2 # +2 because 1 for header, 1 for 0-index
-                    ws.update(f"C{row}:D{row}", [[u_ln, u_fn]])
-                    ws.update_cell(row, 6, u_gr)
-                    ws.update_cell(row, 14, u_st)
-                    st.success("Updated!"); st.cache_data.clear(); time.sleep(1); st.rerun()
+        registrar_list(df_reg, sy_reg, ws_reg, row_of, reg_search)
 
     with t_add:
         with st.form("new_student"):
@@ -235,29 +409,33 @@ def render_registrar(df_reg, df_sf10, sh_reg, sy):
             typ = ca.selectbox("Type", STUDENT_TYPES)
             
             if st.form_submit_button("Enroll Student"):
-                nid = f"{sy[:4]}-{len(df_reg)+1:04d}"
-                sh_reg.worksheet("Student_Registry").append_row([nid, lrn, ln, fn, "", gr, typ, "", "To Follow", "To Follow", "To Follow", "To Request", "FALSE", "Pending", sy])
-                st.success(f"Enrolled {nid}"); st.cache_data.clear(); time.sleep(1); st.rerun()
+                nid = next_student_id(ws_reg, sy)
+                row = [nid, lrn, ln, fn, "", gr, typ, "", "To Follow", "To Follow", "To Follow", "To Request", "FALSE", "Pending", sy]
+                with_retry(ws_reg.append_rows, [row], value_input_option="RAW", insert_data_option="INSERT_ROWS")
+                st.success(f"Enrolled {nid}"); mark_dirty(fetch_registrar); time.sleep(1); st.rerun()
 
     with t_sf10:
-        st.dataframe(df_sf10, use_container_width=True)
+        st.dataframe(df_sf10, use_container_width=True, hide_index=True)
 
 # ==========================================
 # 💰 MODULE: FINANCE
 # ==========================================
 
-def render_finance(df_reg, df_pay, df_sf10, sh_fin, sh_reg, sy):
-    st.subheader(f"💰 Finance & Cashiering ({sy})")
-    sy_reg = df_reg[df_reg["School_Year"] == sy]
+@st.fragment # Picking a student and filling the cashier form rerun only this panel
+def cashier_panel(sy_reg, df_pay, ws_pay, sy):
+    # A fragment rerun skips main(); never price a payment off frames another write has outdated
+    if session_is_stale(): st.rerun(scope="app")
+    by_note, totals = session_memo("payments", lambda: payments_index(df_pay))
     
     c1, c2 = st.columns([1, 2])
     with c1:
         st.markdown("### 💸 New Payment")
-        choice = st.selectbox("Search Student", sy_reg.apply(lambda x: f"{x['Last Name']}, {x['First Name']} ({x['Student_ID']})", axis=1).tolist(), index=None)
-        if choice:
-            sid = choice.split("(")[-1].replace(")", "")
-            stu = sy_reg[sy_reg["Student_ID"] == sid].iloc[0]
-            total, paid, bal = get_financials(sid, stu["Grade Level"], df_pay, sy)
+        ids, labels = session_memo(("choices", sy), lambda: build_search_options(sy_reg))
+        sid = st.selectbox("Search Student", ids, format_func=labels.get, index=None)
+        if sid:
+            # A continuing student has a row per school year; bill against this year's grade
+            stu = sy_reg.loc[session_memo(("row_of", sy), lambda: build_row_index(sy_reg["Student_ID"]))[sid]]
+            total, paid, bal = get_financials(sid, stu["Grade Level"], totals, sy)
             
             st.info(f"**Balance:** ₱{bal:,.2f}")
             with st.form("cashier_form"):
@@ -265,28 +443,41 @@ def render_finance(df_reg, df_pay, df_sf10, sh_fin, sh_reg, sy):
                 orn = st.text_input("OR Number")
                 met = st.selectbox("Method", PAYMENT_METHODS)
                 if st.form_submit_button("Post Transaction"):
-                    allocs = distribute_payment(stu["Grade Level"], amt, df_pay, sid, sy)
-                    ws = sh_fin.worksheet("Payments_Log")
-                    for note, val in allocs.items():
-                        ws.append_row([CURRENT_DATE, orn, sid, f"{stu['Last Name']}, {stu['First Name']}", val, met, note, "Payment", sy])
-                    st.success("Posted!"); st.cache_data.clear(); time.sleep(1); st.rerun()
+                    allocs = distribute_payment(stu["Grade Level"], float(amt),
+                                                paid_by_category(by_note, sid, sy, "DP"),
+                                                paid_by_category(by_note, sid, sy, "Books"))
+                    name = f"{stu['Last Name']}, {stu['First Name']}"
+                    rows = [[CURRENT_DATE, orn, sid, name, val, met, note, "Payment", sy] for note, val in allocs.items()]
+                    if rows: with_retry(ws_pay.append_rows, rows, value_input_option="RAW")
+                    st.success("Posted!"); mark_dirty(fetch_finance); time.sleep(1); st.rerun()
 
     with c2:
-        if choice:
+        if sid:
             st.markdown(f"### 📄 Statements")
             if st.button("Generate SOA PDF"):
-                pdf = generate_soa_fixed(stu, total, paid, bal, sy)
-                b64 = base64.b64encode(pdf).decode()
-                st.markdown(f'<a href="data:application/octet-stream;base64,{b64}" download="SOA_{sid}.pdf">📥 Download Statement</a>', unsafe_allow_html=True)
+                name = f"{stu['Last Name']}, {stu['First Name']}"
+                pdf = generate_soa_fixed(name, stu["Grade Level"], total, paid, bal, sy, datetime.now().strftime('%B %d, %Y'))
+                st.download_button("📥 Download Statement", data=pdf, file_name=f"SOA_{sid}.pdf", mime="application/pdf")
             st.divider()
             st.markdown("### 📒 Payment History")
-            st.dataframe(df_pay[df_pay["Student_ID"] == sid], hide_index=True)
+            # Row positions per student come from one groupby per data load, not a mask per click
+            pay_rows = session_memo("pay_rows", lambda: df_pay.groupby("Student_ID", sort=False).indices)
+            st.dataframe(df_pay.iloc[pay_rows.get(sid, [])], hide_index=True)
+
+
+def render_finance(sy_reg, df_pay, ws_pay, sy):
+    st.subheader(f"💰 Finance & Cashiering ({sy})")
+    cashier_panel(sy_reg, df_pay, ws_pay, sy)
+
 
 # ==========================================
 # 📄 PDF GENERATOR
 # ==========================================
 
-def generate_soa_fixed(student, total, paid, balance, sy):
+# Plain-value args, so repeat clicks on the same statement reuse the bytes. The cache is shared across
+# sessions and the PDFs carry student names, so keep it small and short-lived.
+@st.cache_data(ttl=DATA_TTL, max_entries=32, show_spinner=False)
+def generate_soa_fixed(name, grade, total, paid, balance, sy, as_of):
     pdf = FPDF()
     pdf.add_page()
     pdf.set_font("Arial", "B", 14)
@@ -300,26 +491,32 @@ def generate_soa_fixed(student, total, paid, balance, sy):
     pdf.ln(10)
     
     pdf.set_font("Arial", "", 10)
-    pdf.cell(100, 8, f"Student: {student['Last Name']}, {student['First Name']}", 0, 0)
-    pdf.cell(0, 8, f"Grade: {student['Grade Level']}", 0, 1)
-    pdf.cell(0, 8, f"Date: {datetime.now().strftime('%B %d, %Y')}", 0, 1)
+    pdf.cell(100, 8, f"Student: {name}", 0, 0)
+    pdf.cell(0, 8, f"Grade: {grade}", 0, 1)
+    pdf.cell(0, 8, f"Date: {as_of}", 0, 1)
     pdf.ln(5)
 
     pdf.set_fill_color(240, 240, 240); pdf.set_font("Arial", "B", 10)
     pdf.cell(140, 10, "Description", 1, 0, 'L', True); pdf.cell(50, 10, "Amount", 1, 1, 'C', True)
     
-    pdf.set_font("Arial", "", 10)
-    pdf.cell(140, 10, "Total School Fees", 1); pdf.cell(50, 10, f"{total:,.2f}", 1, 1, 'R')
-    pdf.cell(140, 10, "Less: Payments", 1); pdf.cell(50, 10, f"({paid:,.2f})", 1, 1, 'R')
-    pdf.set_font("Arial", "B", 11)
-    pdf.cell(140, 10, "REMAINING BALANCE", 1); pdf.cell(50, 10, f"PHP {balance:,.2f}", 1, 1, 'R')
+    # (font style, size, description, amount) per table row
+    rows = [
+        ("", 10, "Total School Fees", f"{total:,.2f}"),
+        ("", 10, "Less: Payments", f"({paid:,.2f})"),
+        ("B", 11, "REMAINING BALANCE", f"PHP {balance:,.2f}"),
+    ]
+    for style, size, label, amount in rows:
+        pdf.set_font("Arial", style, size)
+        pdf.cell(140, 10, label, 1); pdf.cell(50, 10, amount, 1, 1, 'R')
     
     # Footer Note
     pdf.ln(20)
     pdf.set_font("Arial", "B", 10)
     pdf.cell(0, 10, "For any queries regarding this statement, please see the Accounting Officer", 0, 1, "C")
     
-    return pdf.output(dest="S").encode("latin-1")
+    out = pdf.output(dest="S")
+    # fpdf2 already returns a bytearray; only legacy PyFPDF hands back a latin-1 str
+    return bytes(out) if isinstance(out, (bytes, bytearray)) else out.encode("latin-1")
 
 # ==========================================
 # 🚀 AUTH & ENTRY POINT
@@ -329,9 +526,10 @@ def main():
     if "logged_in" not in st.session_state: st.session_state.logged_in = False
     
     try:
-        df_reg, df_sf10, df_pay, df_users, sh_reg, sh_fin = load_data()
+        df_reg, df_sf10, df_pay, df_users, ws_reg, ws_pay = get_session_data()
     except Exception as e:
         st.error(f"System Error: {e}"); return
+    row_of = st.session_state.row_of
 
     if not st.session_state.logged_in:
         c1, c2, c3 = st.columns([1, 2, 1])
@@ -343,13 +541,14 @@ def main():
                 sy = st.selectbox("School Year", SCHOOL_YEARS)
                 if st.form_submit_button("Login", use_container_width=True):
                     # Check Secrets First
-                    if u == st.secrets["auth"]["username"] and p == st.secrets["auth"]["password"]:
+                    auth = st.secrets["auth"]
+                    if u == auth["username"] and p == auth["password"]:
                         st.session_state.logged_in = True; st.session_state.role = "Admin"; st.session_state.sy = sy; st.rerun()
                     # Check DB Users Second
                     elif not df_users.empty:
-                        row = df_users[df_users["Username"] == u]
-                        if not row.empty and str(row.iloc[0]["Password"]) == p:
-                            st.session_state.logged_in = True; st.session_state.role = row.iloc[0]["Role"]; st.session_state.sy = sy; st.rerun()
+                        creds = session_memo("users", lambda: build_user_table(df_users)).get(u)
+                        if creds and hmac.compare_digest(creds[0].encode(), p.encode()):
+                            st.session_state.logged_in = True; st.session_state.role = creds[1]; st.session_state.sy = sy; st.rerun()
                         else: st.error("Invalid Credentials")
                     else: st.error("No users in DB")
     else:
@@ -360,11 +559,19 @@ def main():
             if st.session_state.role in ["Registrar", "Admin"]: menu.append("🎓 Admissions")
             if st.session_state.role in ["Finance", "Admin"]: menu.append("💰 Finance")
             page = st.radio("Navigation", menu)
+            if st.button("🔄 Refresh Data"):
+                # Pull edits made elsewhere now instead of waiting out DATA_TTL
+                mark_dirty(fetch_registrar); mark_dirty(fetch_finance); st.rerun()
             if st.button("Logout"): st.session_state.logged_in = False; st.rerun()
 
-        if page == "📊 Dashboard": render_dashboard(df_reg, df_pay, st.session_state.sy)
-        elif page == "🎓 Admissions": render_registrar(df_reg, df_sf10, sh_reg, st.session_state.sy)
-        elif page == "💰 Finance": render_finance(df_reg, df_pay, df_sf10, sh_fin, sh_reg, st.session_state.sy)
+        # School-year slices are filtered once per data load, not once per render
+        sy = st.session_state.sy
+        sy_reg = session_memo(("sy_reg", sy), lambda: df_reg[df_reg["School_Year"] == sy])
+        sy_pay = session_memo(("sy_pay", sy), lambda: df_pay[df_pay["School_Year"] == sy])
+
+        if page == "📊 Dashboard": render_dashboard(sy_reg, sy_pay, sy, session_memo("kpis", lambda: dashboard_kpis(df_reg, df_pay)))
+        elif page == "🎓 Admissions": render_registrar(df_reg, sy_reg, df_sf10, ws_reg, sy, row_of, st.session_state.reg_search)
+        elif page == "💰 Finance": render_finance(sy_reg, df_pay, ws_pay, sy)
 
 if __name__ == "__main__":
     main()